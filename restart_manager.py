@@ -4,134 +4,515 @@ import time
 import threading
 import re
 import signal
-import select
+import selectors
+import heapq
+import queue
 import os
-import psutil
-import io
-from datetime import datetime, timedelta
+import shlex
+import sys
 
-stop_flag = threading.Event()
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
 
-def terminate_process(process, worker_id):
-    if process is None:
-        return
+READ_CHUNK_SIZE = 65536
+MAX_READS_PER_DRAIN = 16
+SELECT_TIMEOUT = 1.0
+PROBE_AFTER = 300.0
+PROBE_GRACE = 1.0
+ERROR_RESTART_DELAY = 5.0
+TERMINATE_TIMEOUT = 3.0
+GROUP_POLL_INTERVAL = 0.1
+LOG_QUEUE_SIZE = 16
+STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP)
 
-    print(f"Worker {worker_id}: Forcefully terminating process...")
-    try:
-        parent = psutil.Process(process.pid)
-        children = parent.children(recursive=True)
-        
-        for child in children:
-            child.terminate()
-        parent.terminate()
-
-        gone, alive = psutil.wait_procs(children + [parent], timeout=3)
-        
-        for p in alive:
-            print(f"Worker {worker_id}: Force killing process {p.pid}")
-            p.kill()
-
-    except psutil.NoSuchProcess:
-        print(f"Worker {worker_id}: Process already terminated")
-    except Exception as e:
-        print(f"Worker {worker_id}: Error while terminating process - {str(e)}")
-    
+# Bounded so a slow stdout blocks the reactor instead of queueing output
+# without limit; not safe to use from signal handlers because of that.
+LOG_Q = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+
+def write_log():
+    while True:
+        messages = [LOG_Q.get()]
+        while True:
+            try:
+                messages.append(LOG_Q.get_nowait())
+            except queue.Empty:
+                break
+        stop = messages[-1] is None
+        if stop:
+            messages.pop()
+        try:
+            sys.stdout.write(''.join(messages))
+            sys.stdout.flush()
+        except OSError:
+            # stdout is gone (e.g. piped into head). Point it at /dev/null and
+            # keep consuming, or the bounded queue would block the reactor for good.
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            os.close(devnull)
+        if stop:
+            return
+
+def extract_literal(pattern):
+    # Longest run of plain characters at the top level of the pattern; every
+    # match has to contain it. Also reports whether that run is the whole pattern.
+    if re.compile(pattern).flags & re.IGNORECASE:
+        return b'', False
+    runs = [[]]
+    parsed = sre_parse.parse(pattern)
+    for op, value in parsed:
+        if op == sre_constants.LITERAL:
+            runs[-1].append(value)
+        elif runs[-1]:
+            runs.append([])
+    longest = max(runs, key=len)
+    return ''.join(map(chr, longest)).encode(), len(longest) == len(parsed)
+
+def nested_subpatterns(value):
+    if isinstance(value, sre_parse.SubPattern):
+        yield value
+    elif isinstance(value, (tuple, list)):
+        for part in value:
+            yield from nested_subpatterns(part)
+
+def literals_are_ascii(items):
+    # True when every character the pattern can match literally is ASCII; an
+    # ASCII source string may still spell others as \xe9, \u00e9 or \N{...}
+    for op, value in items:
+        if op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL):
+            if value >= 128:
+                return False
+        elif op == sre_constants.RANGE:
+            if value[1] >= 128:
+                return False
+        elif op == sre_constants.IN:
+            if not literals_are_ascii(value):
+                return False
+        elif not all(map(literals_are_ascii, nested_subpatterns(value))):
+            return False
+    return True
+
+def compile_bytes_search(pattern):
+    # Bytes patterns skip the Unicode tables for \w, \s, \d and case folding,
+    # but only match like the str pattern when all its literals are ASCII
+    if not literals_are_ascii(sre_parse.parse(pattern)):
+        return None
     try:
-        os.kill(process.pid, 0)
-        print(f"Worker {worker_id}: Process still exists. Force killing...")
-        os.kill(process.pid, signal.SIGKILL)
-    except OSError:
-        pass
-    
-    print(f"Worker {worker_id}: Process termination completed")
-
-def run_worker(command, worker_id, silent, no_output_timeout, restart_pattern):
-    if not silent:
-        print(f"Starting Worker {worker_id}")
-    else:
-        print(f"Worker {worker_id}: Started")
-
-    process = None
-    last_output_time = datetime.now()
-    
-    while not stop_flag.is_set():
-        if process is None or process.poll() is not None:
-            if process is not None:
-                print(f"Worker {worker_id}: Restarting")
-                terminate_process(process, worker_id)
-            process = subprocess.Popen(
-                command,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                bufsize=1,
-                universal_newlines=True
-            )
-
-            last_output_time = datetime.now()
+        return re.compile(pattern.encode()).search
+    except (re.error, ValueError):
+        # Escapes such as \u and \N and the (?u) flag are str-only
+        return None
+
+def compile_restart_pattern(pattern):
+    # Returns the required literal and a matcher; both work on raw bytes lines
+    literal, literal_only = extract_literal(pattern)
+    if literal_only:
+        # A plain string needs no regex engine, a substring test is enough
+        def contains_literal(line):
+            return literal in line
+        return literal, contains_literal
 
+    search = compile_bytes_search(pattern)
+    if search is None:
+        flags = re.ASCII if pattern.isascii() else 0
         try:
-            ready, _, _ = select.select([process.stdout, process.stderr], [], [], 1.0)
-            if ready:
-                for pipe in ready:
-                    buffer = io.StringIO()
-                    while True:
-                        char = pipe.read(1)
-                        if not char:
-                            break
-                        if char == '\r':
-                            buffer.seek(0)
-                            buffer.truncate()
-                        elif char == '\n':
-                            line = buffer.getvalue()
-                            if not silent:
-                                print(f"Worker {worker_id}: {line}")
-                            if re.search(restart_pattern, line):
-                                last_output_time = datetime.now()
-                            buffer.seek(0)
-                            buffer.truncate()
-                        else:
-                            buffer.write(char)
-                    
-                    # Print any remaining content in the buffer
-                    remaining = buffer.getvalue()
-                    if remaining and not silent:
-                        print(f"Worker {worker_id}: {remaining}", end='', flush=True)
-                    
-                    if buffer.tell() > 0:
-                        last_output_time = datetime.now()
+            regex = re.compile(pattern, flags)
+        except (re.error, ValueError):
+            # An explicit (?u) cannot be combined with re.ASCII
+            regex = re.compile(pattern)
+
+        def search(line):
+            return regex.search(line.decode(errors='replace'))
+
+    if not literal:
+        return literal, search
+
+    # Most lines lack the literal, so a substring test rejects them before the regex runs
+    def prefiltered_search(line):
+        return literal in line and search(line)
+    return literal, prefiltered_search
+
+def collapse_carriage_returns(line):
+    # Keep only what is left after the last '\r' overwrite; a trailing '\r'
+    # is kept since it may be the first half of a '\r\n' line ending.
+    start = line.rfind(b'\r', 0, len(line) - 1)
+    return line[start + 1:]
+
+class Worker:
+    def __init__(self, command, worker_id, silent, no_output_timeout, restart_pattern, selector):
+        self.command = command
+        self.worker_id = worker_id
+        self.output_prefix = f"Worker {worker_id}: ".encode()
+        self.silent = silent
+        self.no_output_timeout = no_output_timeout
+        self.timeout_seconds = no_output_timeout * 60.0
+        self.restart_literal, self.restart_matcher = restart_pattern
+        self.selector = selector
+        self.process = None
+        self.pipe = None
+        self.buffer = bytearray()
+        self.last_output_time = time.monotonic()
+        self.last_read_time = self.last_output_time
+        self.probe_time = None
+        self.restart_time = None
+        self.started = False
+        self.dying = None
+        self.kill_signal = None
+        self.kill_time = None
+        self.reap_time = None
+        self.scheduled = None
+
+    def log(self, message):
+        LOG_Q.put(f"Worker {self.worker_id}: {message}\n")
+
+    def start(self):
+        self.started = True
+        if not self.silent:
+            LOG_Q.put(f"Starting Worker {self.worker_id}\n")
+        else:
+            self.log("Started")
+        self.spawn()
+
+    def spawn(self):
+        self.process = subprocess.Popen(
+            self.command,
+            shell=False,
+            start_new_session=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0
+        )
+        pipe = self.process.stdout
+        os.set_blocking(pipe.fileno(), False)
+        self.selector.register(pipe, selectors.EVENT_READ, self)
+        self.pipe = pipe
+        self.buffer = bytearray()
+
+        self.last_output_time = time.monotonic()
+        self.last_read_time = self.last_output_time
+        self.probe_time = None
+        self.restart_time = None
+
+    def kill(self):
+        # Only sends SIGTERM; the reactor reaps the process group once it exits,
+        # so one slow child does not hold up every other worker.
+        if self.pipe is not None:
+            self.selector.unregister(self.pipe)
+            self.pipe = None
+        process, self.process = self.process, None
+        if process is None:
+            return
+
+        process.stdout.close()
+        self.log("Forcefully terminating process...")
+        try:
+            # Workers run in their own session, so the process group id is the pid
+            os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            self.log("Process already terminated")
+        except Exception as e:
+            self.log(f"Error while terminating process - {str(e)}")
+            return
+        self.dying = process
+        self.kill_signal = signal.SIGTERM
+        self.kill_time = time.monotonic() + TERMINATE_TIMEOUT
+        self.reap_time = None
+        # It may have exited before SIGTERM, in which case no SIGCHLD will follow
+        self.reap()
+
+    def reap(self):
+        # The leader exiting is not enough: other members of its group may
+        # ignore SIGTERM, and as they are not our children they send no
+        # SIGCHLD, so the group is polled until it is gone.
+        if self.dying.poll() is None:
+            return
+        try:
+            os.killpg(self.dying.pid, 0)
+        except ProcessLookupError:
+            self.terminated()
+        else:
+            self.reap_time = time.monotonic() + GROUP_POLL_INTERVAL
+
+    def finish_killing(self, force=False):
+        # Does not block; escalates to SIGKILL for the whole group once the
+        # grace period is over, whether or not the leader is still alive.
+        if self.kill_signal == signal.SIGTERM and (force or time.monotonic() >= self.kill_time):
+            self.log("Process still exists. Force killing...")
+            try:
+                os.killpg(self.dying.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.kill_signal = signal.SIGKILL
+            self.kill_time = time.monotonic() + TERMINATE_TIMEOUT
+        self.reap()
+        if self.dying is not None and self.kill_signal == signal.SIGKILL and time.monotonic() >= self.kill_time:
+            # Killed members that remain are zombies whose new parent never
+            # reaps them (e.g. a container without an init process)
+            self.log("Process group still exists after SIGKILL. Giving up on it")
+            self.terminated()
+
+    def terminated(self):
+        self.dying = None
+        self.reap_time = None
+        self.log("Process termination completed")
+
+    def restart(self, reason, delay=0.0):
+        self.log(reason)
+        self.kill()
+        self.restart_time = time.monotonic() + delay
 
+    def fail(self, error):
+        self.restart(f"Error - {str(error)}. Restarting...", ERROR_RESTART_DELAY)
+
+    def stop(self):
+        if self.process:
+            self.log("Stopping")
+            self.kill()
+
+    def drain(self):
+        buffer = self.buffer
+        # The kept tail has no '\n', and no '\r' except maybe as its last byte,
+        # so only what is read now needs searching
+        scanned = max(len(buffer) - 1, 0)
+        received = False
+        eof = False
+        empty = False
+        # Bounded so a child that never pauses cannot starve the other workers
+        # or grow the buffer without limit; the selector reports the pipe again.
+        for _ in range(MAX_READS_PER_DRAIN):
+            try:
+                chunk = os.read(self.pipe.fileno(), READ_CHUNK_SIZE)
+            except BlockingIOError:
+                empty = True
+                break
+            if not chunk:
+                eof = True
+                break
+            buffer += chunk
+            received = True
+
+        if received:
+            self.last_read_time = time.monotonic()
+            end = buffer.rfind(b'\n', scanned)
+            if end >= 0 and self.silent and self.restart_literal:
+                if self.find_heartbeat(buffer, end):
+                    self.last_output_time = self.last_read_time
+                del buffer[:end + 1]
+            elif end >= 0:
+                has_carriage_returns = buffer.find(b'\r', scanned, end) >= 0
+                lines = buffer[:end].split(b'\n')
+                del buffer[:end + 1]
+                if has_carriage_returns:
+                    lines = [collapse_carriage_returns(line).rstrip(b'\r') for line in lines]
+                if not self.silent:
+                    # Prefix, join and decode the whole batch in one go
+                    prefix = self.output_prefix
+                    output = prefix + (b'\n' + prefix).join(lines) + b'\n'
+                    LOG_Q.put(output.decode(errors='replace'))
+                if any(map(self.restart_matcher, lines)):
+                    self.last_output_time = self.last_read_time
+
+            # Only the last '\r' overwrite of an unfinished line can still be shown
+            if end >= 0:
+                scanned = 0
+            start = buffer.rfind(b'\r', scanned, len(buffer) - 1)
+            if start >= 0:
+                del buffer[:start + 1]
+            if buffer:
+                self.last_output_time = self.last_read_time
+
+        # A leader that exited while a grandchild holds the pipe open never
+        # brings EOF, so its exit counts once everything it wrote is read
+        if eof or (empty and self.process.returncode is not None):
+            # Print any remaining content in the buffer
+            if buffer and not self.silent:
+                LOG_Q.put((self.output_prefix + buffer + b'\n').decode(errors='replace'))
+            self.restart("Restarting")
+
+    def find_heartbeat(self, buffer, end):
+        # Silent workers only need to know whether some line matches, so jump
+        # between occurrences of the required literal instead of splitting
+        # every line; only lines that contain it reach the matcher.
+        literal = self.restart_literal
+        position = buffer.find(literal, 0, end)
+        while position >= 0:
+            line_start = buffer.rfind(b'\n', 0, position) + 1
+            line_end = buffer.find(b'\n', position, end)
+            if line_end < 0:
+                line_end = end
+            line = collapse_carriage_returns(buffer[line_start:line_end]).rstrip(b'\r')
+            if self.restart_matcher(line):
+                return True
+            position = buffer.find(literal, line_end + 1, end)
+        return False
+
+    def deadline(self):
+        if self.dying is not None:
+            if self.reap_time is not None:
+                return min(self.kill_time, self.reap_time)
+            return self.kill_time
+        if self.process is None:
+            return self.restart_time
+        timeout = self.last_output_time + self.timeout_seconds
+        if self.probe_time is not None:
+            return min(timeout, self.probe_time + PROBE_GRACE)
+        # The probe only fires once the pipes have also been quiet for a moment
+        probe = max(self.last_output_time + PROBE_AFTER, self.last_read_time + PROBE_GRACE)
+        return min(timeout, probe)
+
+    def check_deadline(self, now):
+        # No respawn while any member of the old process group is still alive
+        if self.dying is not None:
+            self.finish_killing()
+            return
+
+        if self.process is None:
+            if self.started:
+                self.spawn()
             else:
-                if process.poll() is None:
-                    if datetime.now() - last_output_time > timedelta(seconds=300):
-                        print(f"Worker {worker_id}: No output for 300 seconds. Checking process...")
-                        process.send_signal(signal.SIGURG)
-                        time.sleep(1)
-                        if process.poll() is None:
-                            print(f"Worker {worker_id}: Process is still running but unresponsive. Restarting...")
-                            terminate_process(process, worker_id)
-                            process = None
-                            last_output_time = datetime.now()
-                
-            if datetime.now() - last_output_time > timedelta(minutes=no_output_timeout):
-                print(f"Worker {worker_id}: No output detected for {no_output_timeout} minutes. Restarting...")
-                terminate_process(process, worker_id)
-                process = None
-                last_output_time = datetime.now()
+                self.start()
+            return
+
+        if self.process.poll() is not None:
+            self.drain()
+            return
+
+        # Same expressions as deadline(), so a deadline that fired always acts
+        if now >= self.last_output_time + self.timeout_seconds:
+            self.restart(f"No output detected for {self.no_output_timeout} minutes. Restarting...")
+        elif self.probe_time is not None:
+            if now >= self.probe_time + PROBE_GRACE:
+                self.restart("Process is still running but unresponsive. Restarting...")
+        elif now >= self.last_output_time + PROBE_AFTER and now >= self.last_read_time + PROBE_GRACE:
+            self.log("No output for 300 seconds. Checking process...")
+            self.process.send_signal(signal.SIGURG)
+            self.probe_time = now
+
+class PipeReactor:
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.workers = []
+        self.deadlines = []
+        self.stop_signal = None
+        self.shutting_down = False
+        self.force = False
+        # Self-pipe the signal module writes to, so a signal wakes select() at once
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+        self.selector.register(self.wakeup_read, selectors.EVENT_READ)
+
+    def add(self, worker, start_time):
+        worker.restart_time = start_time
+        self.workers.append(worker)
+        self.schedule(worker)
+
+    def schedule(self, worker):
+        # Keep one live heap entry per worker; a later deadline is picked up
+        # lazily when the current entry fires, an earlier one needs a new entry.
+        deadline = worker.deadline()
+        if deadline is not None and (worker.scheduled is None or deadline < worker.scheduled):
+            worker.scheduled = deadline
+            heapq.heappush(self.deadlines, (deadline, worker.worker_id, worker))
 
+    def guard(self, worker, action, *args):
+        try:
+            action(*args)
         except Exception as e:
-            print(f"Worker {worker_id}: Error - {str(e)}. Restarting...")
-            terminate_process(process, worker_id)
-            process = None
-            time.sleep(5)
+            worker.fail(e)
+
+    def fire_deadlines(self):
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            scheduled, _, worker = heapq.heappop(self.deadlines)
+            if scheduled != worker.scheduled:
+                continue
+            worker.scheduled = None
+            # Output since the push may have moved the real deadline forward
+            deadline = worker.deadline()
+            if deadline is not None and deadline <= now:
+                self.guard(worker, worker.check_deadline, now)
+            self.schedule(worker)
+
+    def select_timeout(self):
+        if not self.deadlines:
+            return SELECT_TIMEOUT
+        remaining = self.deadlines[0][0] - time.monotonic()
+        return min(SELECT_TIMEOUT, max(0.0, remaining))
+
+    def read_signals(self):
+        while True:
+            try:
+                signals = os.read(self.wakeup_read, READ_CHUNK_SIZE)
+            except BlockingIOError:
+                return
+            if signal.SIGCHLD in signals:
+                self.reap_workers()
 
-    if process:
-        print(f"Worker {worker_id}: Stopping")
-        terminate_process(process, worker_id)
+    def reap_workers(self):
+        # One SIGCHLD may stand for several exits, so check every worker. A
+        # running child that exited is drained first so its last output is
+        # kept; drain() restarts it once the pipe is empty, even if a
+        # grandchild still holds the pipe open and no EOF arrives.
+        for worker in self.workers:
+            if worker.dying is not None:
+                self.guard(worker, worker.reap)
+            elif worker.process is not None and worker.process.poll() is not None:
+                self.guard(worker, worker.drain)
+            else:
+                continue
+            self.schedule(worker)
+
+    def run(self):
+        signal.set_wakeup_fd(self.wakeup_write, warn_on_full_buffer=False)
+        # A Python-level handler is needed for SIGCHLD to reach the wakeup pipe
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        try:
+            while self.stop_signal is None:
+                for key, _ in self.selector.select(self.select_timeout()):
+                    worker = key.data
+                    if worker is None:
+                        self.read_signals()
+                    elif key.fileobj is worker.pipe:
+                        self.guard(worker, worker.drain)
+                        self.schedule(worker)
+                self.fire_deadlines()
+        finally:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.set_wakeup_fd(-1)
 
-def signal_handler(signum, frame):
-    print("\nCtrl+C pressed. Stopping all workers...")
-    stop_flag.set()
+        self.shutting_down = True
+        if self.stop_signal == signal.SIGINT:
+            LOG_Q.put("\nCtrl+C pressed. Stopping all workers...\n")
+        else:
+            LOG_Q.put(f"\n{signal.Signals(self.stop_signal).name} received. Stopping all workers...\n")
+        self.stop_workers()
+        self.selector.close()
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+
+    def stop_workers(self):
+        # Signal every worker first so their grace periods run concurrently,
+        # then wait in short slices so a second signal takes effect at once
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            while worker.dying is not None:
+                worker.finish_killing(self.force)
+                if worker.dying is not None:
+                    time.sleep(GROUP_POLL_INTERVAL)
+
+    def interrupt(self, signum, frame):
+        if self.shutting_down:
+            # A second Ctrl+C or stop signal skips the remaining grace periods.
+            # Only a flag: an exception could land halfway through kill() and
+            # leave a process group that nothing waits for.
+            self.force = True
+        else:
+            # Also set here, as the wakeup pipe is only installed while run() loops
+            self.stop_signal = signum
 
 def main():
     parser = argparse.ArgumentParser(description="Universal restart manager")
@@ -139,26 +520,41 @@ def main():
     parser.add_argument("instances", type=int, help="Number of instances to run in parallel")
     parser.add_argument("restart_pattern", help="Regular expression pattern to check for successful execution or heartbeat")
     parser.add_argument("--silent", action="store_true", help="Enable silent mode (only output logs about starting/restarting workers)")
+    parser.add_argument("--shell", action="store_true", help="Run the command through /bin/sh (needed for pipes, redirects and other shell syntax)")
     parser.add_argument("--no-output-timeout", type=int, default=5, help="Timeout in minutes for no output before restarting")
+    parser.add_argument("--stagger", type=float, default=0.0, help="Seconds between starting consecutive workers (use 1 for the old one-second ramp)")
     args = parser.parse_args()
 
-    signal.signal(signal.SIGINT, signal_handler)
+    if args.shell:
+        command = ["/bin/sh", "-c", args.command]
+    else:
+        command = shlex.split(args.command)
+    restart_pattern = compile_restart_pattern(args.restart_pattern)
+
+    reactor = PipeReactor()
+    # Workers run in their own sessions and miss terminal signals, so any
+    # of these has to stop them through the reactor
+    for signum in STOP_SIGNALS:
+        signal.signal(signum, reactor.interrupt)
+
+    writer_thread = threading.Thread(target=write_log, daemon=True)
+    writer_thread.start()
 
     if not args.silent:
-        print(f"Starting {args.instances} workers")
+        LOG_Q.put(f"Starting {args.instances} workers\n")
 
-    threads = []
+    start_time = time.monotonic()
     for i in range(args.instances):
-        thread = threading.Thread(target=run_worker, args=(args.command, i, args.silent, args.no_output_timeout, args.restart_pattern))
-        thread.start()
-        threads.append(thread)
-        time.sleep(1)
+        worker = Worker(command, i, args.silent, args.no_output_timeout, restart_pattern, reactor.selector)
+        reactor.add(worker, start_time + i * args.stagger)
 
-    for thread in threads:
-        thread.join()
+    reactor.run()
 
     if not args.silent:
-        print("All workers have finished")
+        LOG_Q.put("All workers have finished\n")
+
+    LOG_Q.put(None)
+    writer_thread.join()
 
 if __name__ == "__main__":
     main()